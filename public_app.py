@@ -8,23 +8,44 @@
 # raw_bucket_name = "feedback-proto-ai-raw"
 # raw_prefix      = "raw_submissions"
 #
+# (선택) system_instruction     = "..."   # 고정 시스템 프롬프트 (Vertex 컨텍스트 캐시 사용)
+# (선택) fuzzy_cache            = true    # 유사 프롬프트 응답 재사용
+# (선택) hedge_base_after_s     = 8       # N초 뒤 베이스모델 동시 호출
+# (선택) vertex_max_concurrency = 8       # 프로세스당 동시 Vertex 호출 수
+# (선택) batch_submissions      = true    # 제출을 NDJSON 묶음으로 업로드
+#
 # [gcp_service_account]
 # ...서비스계정 JSON 원문 전체...
 # -----------------------------------------------------------
 
 from __future__ import annotations
-import io
-import json
-import uuid
-from datetime import datetime
-from typing import Dict, Any, List, Tuple
+import asyncio
+import hashlib
+import queue
+import secrets
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from difflib import SequenceMatcher
+from typing import Dict, Any, Iterator, List, Tuple
 
+import orjson
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from google.api_core.exceptions import (
+    BadGateway, GatewayTimeout, InternalServerError, ServiceUnavailable, TooManyRequests,
+)
 from google.oauth2 import service_account
 from google.cloud import storage
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
 import vertexai
 from vertexai.generative_models import GenerativeModel
+from vertexai.preview import caching
 
 # ---------------- 기본 설정 ----------------
 st.set_page_config(page_title="🐸 개구리 학습 피드백 (Public)", page_icon="🐸", layout="centered")
@@ -34,6 +55,20 @@ LOCATION   = st.secrets.get("location", "us-central1")
 TUNED_NAME = (st.secrets.get("tuned_model_name") or "").strip()
 RAW_BUCKET = st.secrets.get("raw_bucket_name")
 RAW_PREFIX = (st.secrets.get("raw_prefix") or "raw_submissions").strip().strip("/")
+BASE_MODEL = "gemini-1.5-pro-002"   # 튜닝모델 실패 시 폴백
+END_MARKER = "<END>"
+STOP_SEQUENCES = [END_MARKER, "\n\n[끝]"]
+SYSTEM_INSTRUCTION = (st.secrets.get("system_instruction") or "").strip()
+if SYSTEM_INSTRUCTION:
+    SYSTEM_INSTRUCTION += f"\n\n답변을 마치면 마지막에 {END_MARKER} 를 출력하세요."
+CONTEXT_CACHE_TTL = timedelta(hours=1)
+CONTEXT_CACHE_RETRY_S = 60   # 연장 실패 시 재시도 간격
+BATCH_SUBMISSIONS = bool(st.secrets.get("batch_submissions", False))   # true면 NDJSON 묶음 업로드
+BATCH_MAX_RECORDS = 100
+BATCH_MAX_WAIT_S  = 30
+VERTEX_MAX_CONCURRENCY = int(st.secrets.get("vertex_max_concurrency", 8))   # 쿼터에 맞게 조정
+# 설정 시 튜닝모델이 N초 내 응답 없으면 베이스모델 동시 호출 (잘못된 값은 호출 때가 아니라 시작 시 실패)
+HEDGE_AFTER_S: float | None = float(v) if (v := st.secrets.get("hedge_base_after_s")) is not None else None
 
 # Secrets 점검
 if not (PROJECT_ID and LOCATION and TUNED_NAME and RAW_BUCKET):
@@ -41,82 +76,466 @@ if not (PROJECT_ID and LOCATION and TUNED_NAME and RAW_BUCKET):
     st.stop()
 
 # ---------------- 인증/클라이언트 ----------------
-try:
-    credentials = service_account.Credentials.from_service_account_info(
-        st.secrets["gcp_service_account"],
-        scopes=["https://www.googleapis.com/auth/cloud-platform"],
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+# 서비스계정 키 파싱/RSA 로드는 프로세스당 1회 (실패는 캐시되지 않음)
+@st.cache_resource
+def _creds() -> service_account.Credentials:
+    return service_account.Credentials.from_service_account_info(
+        dict(st.secrets["gcp_service_account"]),
+        scopes=SCOPES,
     )
+
+@st.cache_resource
+def _init_vertex(project_id: str, location: str, _credentials) -> None:
+    vertexai.init(project=project_id, location=location, credentials=_credentials)
+
+try:
+    credentials = _creds()
 except Exception as e:
     st.error("Secrets의 [gcp_service_account] JSON을 확인하세요.\n" + repr(e))
     st.stop()
 
-vertexai.init(project=PROJECT_ID, location=LOCATION, credentials=credentials)
-storage_client = storage.Client(project=PROJECT_ID, credentials=credentials)
+_init_vertex(PROJECT_ID, LOCATION, credentials)
+
+# 클라이언트/모델 핸들은 프로세스당 1회만 생성해 세션 간 공유 (rerun마다 재생성 방지)
+@st.cache_resource
+def get_storage_client(project_id: str, _credentials) -> storage.Client:
+    return storage.Client(project=project_id, credentials=_credentials)
+
+def _keep_cache_alive(cache: caching.CachedContent):
+    # TTL 만료 전에 주기적으로 연장, 실패하면 짧은 간격으로 재시도
+    ttl_s = CONTEXT_CACHE_TTL.total_seconds()
+    expires_at = time.monotonic() + ttl_s
+    wait = ttl_s * 0.75
+    while True:
+        time.sleep(wait)
+        try:
+            cache.update(ttl=CONTEXT_CACHE_TTL)
+            expires_at = time.monotonic() + ttl_s
+            wait = ttl_s * 0.75
+        except Exception:
+            traceback.print_exc()
+            if time.monotonic() + CONTEXT_CACHE_RETRY_S >= expires_at:
+                # 만료 전에 연장하지 못함 → 죽은 캐시를 가리키는 모델 핸들을 버려 다음 호출에서 새로 생성
+                get_tuned_model.clear()
+                return
+            wait = CONTEXT_CACHE_RETRY_S
+
+@st.cache_resource
+def get_tuned_model(model_name: str, system_instruction: str = SYSTEM_INSTRUCTION) -> GenerativeModel:
+    if not system_instruction:
+        return GenerativeModel(model_name)
+    # 고정 시스템 프롬프트는 컨텍스트 캐시에 한 번 올려두고 호출마다 재과금/재계산하지 않음
+    try:
+        cache = caching.CachedContent.create(
+            model_name=model_name,
+            system_instruction=system_instruction,
+            ttl=CONTEXT_CACHE_TTL,
+        )
+    except Exception:
+        # 최소 토큰 수 미달/미지원 모델 등 → 캐시 없이 system_instruction만 적용
+        traceback.print_exc()
+        return GenerativeModel(model_name, system_instruction=system_instruction)
+    threading.Thread(target=_keep_cache_alive, args=(cache,), name="context-cache-refresh", daemon=True).start()
+    return GenerativeModel.from_cached_content(cached_content=cache)
+
+@st.cache_resource
+def get_base_model(model_name: str = BASE_MODEL, system_instruction: str = SYSTEM_INSTRUCTION) -> GenerativeModel:
+    return GenerativeModel(model_name, system_instruction=system_instruction or None)
+
+# 병렬 업로드용: 스레드끼리 한 클라이언트를 공유하지 않도록 워커별 클라이언트 풀
+@st.cache_resource
+def _client_pool(project_id: str, _credentials, n: int = 8) -> List[storage.Client]:
+    return [storage.Client(project=project_id, credentials=_credentials) for _ in range(n)]
+
+storage_client = get_storage_client(PROJECT_ID, credentials)
 
 # ---------------- 모델 호출/유틸 ----------------
 def _gen_cfg() -> Dict[str, Any]:
-    # 최소 옵션만 사용 (InvalidArgument 방지)
-    return {
-        "max_output_tokens": 2048,   # 필요하면 4096까지
+    # 기본 샘플링 옵션 + (시스템 프롬프트가 END_MARKER를 지시할 때만) stop_sequences
+    cfg: Dict[str, Any] = {
+        "max_output_tokens": 1024,   # 대부분 600토큰 이내로 끝남, 필요하면 2048까지
         "temperature": 0.7,
         "top_p": 0.95,
     }
+    if SYSTEM_INSTRUCTION:
+        cfg["stop_sequences"] = STOP_SEQUENCES   # 자연스러운 끝에서 바로 종료
+    return cfg
+
+# 모든 세션이 공유하는 동시 호출 제한 (429 폭주 방지)
+@st.cache_resource
+def _vertex_sem() -> threading.BoundedSemaphore:
+    return threading.BoundedSemaphore(VERTEX_MAX_CONCURRENCY)
+
+# 일시적 오류(429/500/502/503/504, 연결 끊김)만 지터 포함 지수 백오프로 재시도
+# TooManyRequests는 HTTP 429(GCS/REST)와 gRPC RESOURCE_EXHAUSTED(하위 클래스) 둘 다 잡음
+_TRANSIENT_ERRORS = (
+    TooManyRequests, InternalServerError, BadGateway, ServiceUnavailable, GatewayTimeout,
+    ConnectionResetError, RequestsConnectionError,
+)
+
+# Vertex 호출용 (동기/비동기 공용) — 429 쿼터 회복을 기다리도록 대기 상한을 길게
+_vertex_retry = retry(
+    retry=retry_if_exception_type(_TRANSIENT_ERRORS),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+
+# GCS 업로드용 — 객체 키가 고정이라 재시도해도 같은 객체를 덮어쓸 뿐 (멱등)
+_gcs_retry = retry(
+    retry=retry_if_exception_type(_TRANSIENT_ERRORS),
+    wait=wait_random_exponential(min=0.5, max=15),
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+
+def _contents(prompt: str) -> List[Dict[str, Any]]:
+    return [{"role":"user","parts":[{"text":prompt}]}]
+
+@_vertex_retry
+def _generate_content(gm: GenerativeModel, prompt: str, cfg: Dict[str, Any]):
+    # 백오프 대기 중에는 슬롯을 잡지 않도록 세마포어는 시도마다 획득
+    with _vertex_sem():
+        return gm.generate_content(
+            contents=_contents(prompt),
+            generation_config=cfg,
+        )
+
+@_vertex_retry
+async def _generate_content_async(gm: GenerativeModel, sem: threading.BoundedSemaphore,
+                                  prompt: str, cfg: Dict[str, Any]):
+    # 취소되어도 슬롯이 새지 않도록 블로킹 acquire 대신 폴링
+    while not sem.acquire(blocking=False):
+        await asyncio.sleep(0.05)
+    try:
+        return await gm.generate_content_async(
+            contents=_contents(prompt),
+            generation_config=cfg,
+        )
+    finally:
+        sem.release()
 
 def _extract_text(r) -> str:
-    # r.text 우선, 없으면 candidates.parts[*].text 수집
-    if getattr(r, "text", None):
-        return (r.text or "").strip()
-    pieces: List[str] = []
-    for c in getattr(r, "candidates", []) or []:
-        content = getattr(c, "content", None)
-        parts = getattr(content, "parts", None) if content else None
-        if parts:
-            for p in parts:
-                t = getattr(p, "text", None)
-                if t:
-                    pieces.append(t)
-    return "\n".join(pieces).strip()
+    # r.text 우선 (SDK는 텍스트가 없으면 ValueError), 없으면 candidates.parts[*].text를 바로 join
+    try:
+        if r.text:
+            return r.text.strip()
+    except (AttributeError, ValueError):
+        pass
+    try:
+        return "\n".join(
+            p.text for c in (r.candidates or ()) for p in (c.content.parts or ())
+            if getattr(p, "text", None)
+        ).strip()
+    except AttributeError:
+        return ""
+
+# 비동기 경로는 프로세스당 하나의 이벤트 루프(백그라운드 스레드)에서만 실행
+# (모델 인스턴스가 잡아두는 async gRPC 클라이언트가 처음 쓴 루프에 묶이므로 asyncio.run으로 매번 새 루프를 만들면 안 됨)
+@st.cache_resource
+def _async_loop() -> asyncio.AbstractEventLoop:
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="vertex-async-loop", daemon=True).start()
+    return loop
+
+async def _generate_hedged(model_name: str, tuned_gm: GenerativeModel, base_gm: GenerativeModel,
+                           sem: threading.BoundedSemaphore, prompt: str, cfg: Dict[str, Any],
+                           delay: float) -> Tuple[str, Dict[str, Any]]:
+    # 튜닝모델 먼저 → delay초 안에 못 받으면(또는 실패하면) 베이스모델도 출발, 먼저 온 비어있지 않은 응답 사용
+    meta: Dict[str, Any] = {"route": []}
+
+    async def attempt(gm: GenerativeModel) -> str:
+        return _extract_text(await _generate_content_async(gm, sem, prompt, cfg))
+
+    names: Dict[asyncio.Task, str] = {}
+
+    def settle(t: asyncio.Task) -> str:
+        if t.exception() is not None:
+            meta["route"].append({"name": names[t], "error": repr(t.exception())})
+            return ""
+        meta["route"].append({"name": names[t], "ok": bool(t.result())})
+        return t.result()
+
+    tuned = asyncio.create_task(attempt(tuned_gm))
+    names[tuned] = "tuned-async"
+    done, _ = await asyncio.wait({tuned}, timeout=delay)
+    if done and (text := settle(tuned)):
+        meta["answered_by"] = model_name
+        return text, meta
+
+    base = asyncio.create_task(attempt(base_gm))
+    names[base] = "base-async"
+    pending = {base} if done else {tuned, base}
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        # 같이 끝난 태스크도 모두 settle (예외 회수 + route 기록), 둘 다 성공이면 튜닝모델 우선
+        results = {t: settle(t) for t in done}
+        winner = next((t for t in (tuned, base) if results.get(t)), None)
+        if winner is not None:
+            meta["answered_by"] = BASE_MODEL if winner is base else model_name
+            for loser in pending:
+                loser.cancel()
+            return results[winner], meta
+    return "", meta
+
+def _generate(model_name: str, prompt: str, cfg: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    if HEDGE_AFTER_S is not None:
+        # 캐시된 모델 핸들/세마포어는 호출 스레드에서 꺼내 루프 스레드로 넘김 (루프 스레드에서 st.cache_* 호출 안 함)
+        coro = _generate_hedged(model_name, get_tuned_model(model_name), get_base_model(), _vertex_sem(),
+                                prompt, cfg, HEDGE_AFTER_S)
+        return asyncio.run_coroutine_threadsafe(coro, _async_loop()).result()
 
-def call_model_tuned(prompt: str) -> Tuple[str, Dict[str, Any]]:
     meta: Dict[str, Any] = {"route": []}
 
     # 1) 튜닝모델 동기 호출
     try:
-        gm = GenerativeModel(TUNED_NAME)
-        r = gm.generate_content(
-            contents=[{"role":"user","parts":[{"text":prompt}]}],
-            generation_config=_gen_cfg(),
-        )
+        r = _generate_content(get_tuned_model(model_name), prompt, cfg)
         text = _extract_text(r)
         meta["route"].append({"name":"tuned-sync", "ok": bool(text)})
         if text:
+            meta["answered_by"] = model_name
             return text, meta
     except Exception as e:
         meta["route"].append({"name":"tuned-sync", "error": repr(e)})
 
     # 2) 베이스모델 폴백
     try:
-        base = GenerativeModel("gemini-1.5-pro-002")
-        r2 = base.generate_content(
-            contents=[{"role":"user","parts":[{"text":prompt}]}],
-            generation_config=_gen_cfg(),
-        )
+        r2 = _generate_content(get_base_model(), prompt, cfg)
         text2 = _extract_text(r2)
         meta["route"].append({"name":"base-sync", "ok": bool(text2)})
+        if text2:
+            meta["answered_by"] = BASE_MODEL
         return text2, meta
     except Exception as e:
         meta["route"].append({"name":"base-sync", "error": repr(e)})
         return "", meta
 
-def _upload_json(bucket: str, key: str, obj: Dict[str, Any]):
-    b = storage_client.bucket(bucket).blob(key)
-    data = json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+# 같은 (모델, 프롬프트, 생성옵션)이면 Vertex를 다시 부르지 않고 캐시에서 반환
+# 스트리밍 미리보기도 조회/저장해야 해서 st.cache_data 대신 직접 관리하는 TTL+LRU 캐시 사용
+class _ResponseCache:
+    def __init__(self, ttl_s: float, max_entries: int):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data: OrderedDict[tuple, Tuple[float, str, Dict[str, Any]]] = OrderedDict()
+
+    def get(self, key: tuple) -> Tuple[str, Dict[str, Any]] | None:
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return None
+            if time.monotonic() - hit[0] > self.ttl_s:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return hit[1], hit[2]
+
+    def put(self, key: tuple, text: str, meta: Dict[str, Any]):
+        with self._lock:
+            self._data[key] = (time.monotonic(), text, meta)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+@st.cache_resource
+def _response_cache() -> _ResponseCache:
+    return _ResponseCache(ttl_s=3600, max_entries=1024)
+
+def _cache_key(model_name: str, prompt: str, cfg: Dict[str, Any]) -> tuple:
+    # 시스템 프롬프트도 키에 포함 → secret이 바뀌면 이전 지시로 만든 초안을 재사용하지 않음
+    return (
+        model_name,
+        hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+        hashlib.sha256(SYSTEM_INSTRUCTION.encode("utf-8")).hexdigest(),
+        repr(sorted(cfg.items())),
+    )
+
+def _cached_call(model_name: str, prompt: str, cfg: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    key = _cache_key(model_name, prompt, cfg)
+    hit = _response_cache().get(key)
+    if hit is not None:
+        return hit
+    text, meta = _generate(model_name, prompt, cfg)
+    # 빈 응답/베이스모델 폴백 응답은 캐시하지 않음 (튜닝모델 키로 베이스 답이 재사용되지 않게)
+    if text and meta.get("answered_by") == model_name:
+        _response_cache().put(key, text, meta)
+    return text, meta
+
+# 유사 프롬프트 재사용 (Secrets에 fuzzy_cache = true 일 때만)
+FUZZY_CACHE = bool(st.secrets.get("fuzzy_cache", False))
+FUZZY_RATIO = 0.95
+
+@st.cache_resource
+def _recent_prompts() -> deque:
+    return deque(maxlen=64)
+
+def _nearest_prompt(prompt: str) -> str:
+    # 다른 세션/미리 생성 스레드가 동시에 append 하므로 스냅샷을 순회
+    for prev in reversed(list(_recent_prompts())):
+        if prev == prompt or SequenceMatcher(None, prev, prompt).ratio() > FUZZY_RATIO:
+            return prev
+    return prompt
+
+def call_model_tuned(prompt: str) -> Tuple[str, Dict[str, Any]]:
+    if FUZZY_CACHE:
+        prompt = _nearest_prompt(prompt)
+    text, meta = _cached_call(TUNED_NAME, prompt, _gen_cfg())
+    if FUZZY_CACHE and text and prompt not in _recent_prompts():
+        _recent_prompts().append(prompt)
+    return text, meta
+
+def cached_draft(prompt: str) -> str | None:
+    # 미리보기용: 이미 생성된 초안이 캐시에 있으면 Vertex 호출 없이 반환
+    if FUZZY_CACHE:
+        prompt = _nearest_prompt(prompt)
+    hit = _response_cache().get(_cache_key(TUNED_NAME, prompt, _gen_cfg()))
+    return hit[0] if hit else None
+
+def remember_draft(prompt: str, text: str, meta: Dict[str, Any]):
+    # 스트리밍으로 받은 초안을 응답 캐시에 넣어 같은 입력의 재미리보기/제출에서 재사용
+    _response_cache().put(_cache_key(TUNED_NAME, prompt, _gen_cfg()), text, meta)
+    if FUZZY_CACHE and prompt not in _recent_prompts():
+        _recent_prompts().append(prompt)
+
+# 동의 체크 시점에 초안을 미리 생성해 두어 '제출' 때 대기 시간을 숨김
+@st.cache_resource
+def _prefetcher() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="draft-prefetch")
+
+def _run_with_ctx(ctx, fn, *args):
+    # 워커 스레드에 세션의 ScriptRunContext를 붙여 st.cache_* 호출 시 경고가 나지 않게 함
+    add_script_run_ctx(threading.current_thread(), ctx)
+    return fn(*args)
+
+def _prefetch_draft():
+    # pub_consent on_change 콜백: 동의 + 입력 있음 + 초안 없음일 때만 백그라운드 생성 시작
+    p = st.session_state.get("pub_prompt", "")
+    if st.session_state.get("pub_consent") and p.strip() and not st.session_state.get("draft_text"):
+        fut = _prefetcher().submit(_run_with_ctx, get_script_run_ctx(), call_model_tuned, p)
+        st.session_state["_prefetch"] = (p, fut)
+
+def _take_prefetched(prompt: str) -> str | None:
+    # 같은 입력으로 미리 만든 초안이 있으면 (필요 시 완료까지 기다려) 반환
+    pf = st.session_state.pop("_prefetch", None)
+    if not pf or pf[0] != prompt:
+        return None
+    try:
+        text, _ = pf[1].result()
+    except Exception:
+        return None
+    return text or None
+
+def stream_tuned(prompt: str) -> Iterator[str]:
+    # 튜닝모델 스트리밍 호출: 청크가 도착하는 대로 바로 넘겨준다
+    gm = get_tuned_model(TUNED_NAME)
+    with _vertex_sem():
+        for chunk in gm.generate_content(
+            contents=_contents(prompt),
+            generation_config=_gen_cfg(),
+            stream=True,
+        ):
+            # 파트 없는 청크(종료 사유만 담긴 마지막 청크 등)는 .text에서 ValueError
+            try:
+                t = chunk.text
+            except (AttributeError, ValueError):
+                continue
+            if t:
+                yield t
+
+@_gcs_retry
+def _upload_json(bucket: str, key: str, obj: Dict[str, Any], client: storage.Client | None = None):
+    # chunk_size=None + 작은 페이로드 → resumable 세션 없이 multipart 단일 요청으로 업로드
+    b = (client or storage_client).bucket(bucket).blob(key, chunk_size=None)
+    data = orjson.dumps(obj)   # 압축 포맷 UTF-8 bytes를 바로 반환 (ensure_ascii=False와 동일)
     b.cache_control = "no-cache"
-    b.upload_from_file(io.BytesIO(data), size=len(data), content_type="application/json")
+    b.upload_from_string(data, content_type="application/json")
+
+def _upload_many(bucket: str, items: List[Tuple[str, Dict[str, Any]]],
+                 clients: List[storage.Client]) -> List[Exception | None]:
+    # 여러 레코드를 워커 스레드별 클라이언트로 병렬 업로드, 항목별 결과(None=성공) 반환
+    # _upload_json을 그대로 써서 multipart 단일 요청 + _gcs_retry 정책을 유지
+    n = len(clients)
+
+    def task(i: int, key: str, obj: Dict[str, Any]):
+        _upload_json(bucket, key, obj, client=clients[i % n])
+
+    with ThreadPoolExecutor(max_workers=n, thread_name_prefix="gcs-upload-many") as ex:
+        futs = [ex.submit(task, i, key, obj) for i, (key, obj) in enumerate(items)]
+    return [f.exception() for f in futs]
 
-def _raw_key_for_today() -> str:
-    day = datetime.utcnow().strftime("%Y-%m-%d")
-    return f"{RAW_PREFIX}/{day}/{uuid.uuid4().hex[:10]}.json"
+# 제출 업로드는 백그라운드 스레드에서 처리해 클릭 응답을 막지 않음
+@st.cache_resource
+def _uploader() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="gcs-upload")
+
+def _sweep_pending_uploads():
+    # 지난 rerun에서 넘긴 업로드 중 끝난 것을 정리하고, 실패는 화면에 알림
+    pending: List[Future] = st.session_state.get("_pending", [])
+    still: List[Future] = []
+    for fut in pending:
+        if not fut.done():
+            still.append(fut)
+        elif fut.exception() is not None:
+            st.error("이전 제출의 저장에 실패했습니다. 다시 제출해주세요.")
+            st.exception(fut.exception())
+    st.session_state["_pending"] = still
+
+def _raw_key_for_day(day: str) -> str:
+    return f"{RAW_PREFIX}/{day}/{secrets.token_hex(5)}.json"
+
+def _raw_batch_key_for_day(day: str) -> str:
+    return f"{RAW_PREFIX}/{day}/batch_{int(time.time())}_{secrets.token_hex(3)}.ndjson"
+
+def _record_day(record: Dict[str, Any]) -> str:
+    # 제출 시각("YYYY-MM-DDTHH:MM:SSZ") 기준 날짜 → 자정 직전 제출이 다음 날 폴더로 가지 않게
+    return record["timestamp"][:10]
+
+# ---------------- 제출 묶음 업로드 (batch_submissions) ----------------
+@_gcs_retry
+def _upload_ndjson(bucket: str, key: str, records: List[Dict[str, Any]]):
+    # 줄마다 레코드 1개, 마지막 줄도 개행으로 끝내야 compose 후에도 NDJSON이 유지됨
+    lines = b"".join(orjson.dumps(r, option=orjson.OPT_APPEND_NEWLINE) for r in records)
+    b = storage_client.bucket(bucket).blob(key, chunk_size=None)
+    b.cache_control = "no-cache"
+    b.upload_from_string(lines, content_type="application/x-ndjson")
+
+def _flush_loop(q: queue.Queue, clients: List[storage.Client]):
+    # 최대 BATCH_MAX_RECORDS개 또는 첫 레코드 후 BATCH_MAX_WAIT_S초가 지나면 한 번에 업로드
+    while True:
+        batch = [q.get()]
+        deadline = time.monotonic() + BATCH_MAX_WAIT_S
+        while len(batch) < BATCH_MAX_RECORDS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # 자정을 걸친 묶음은 날짜별로 나눠 각 날짜 폴더에 업로드
+        by_day: Dict[str, List[Dict[str, Any]]] = {}
+        for rec in batch:
+            by_day.setdefault(_record_day(rec), []).append(rec)
+        for day, records in by_day.items():
+            try:
+                _upload_ndjson(RAW_BUCKET, _raw_batch_key_for_day(day), records)
+            except Exception:
+                traceback.print_exc()
+                # 묶음 업로드가 실패하면 레코드를 잃지 않도록 개별 업로드로 재시도
+                errors = _upload_many(RAW_BUCKET, [(_raw_key_for_day(day), rec) for rec in records], clients)
+                for err in errors:
+                    if err is not None:
+                        traceback.print_exception(type(err), err, err.__traceback__)
+
+@st.cache_resource
+def _submission_queue() -> queue.Queue:
+    q: queue.Queue = queue.Queue()
+    # 클라이언트 풀은 스크립트 스레드에서 꺼내 넘김 (플러셔 스레드에서 st.cache_* 호출 안 함)
+    clients = _client_pool(PROJECT_ID, credentials)
+    threading.Thread(target=_flush_loop, args=(q, clients), name="raw-batch-flusher", daemon=True).start()
+    return q
 
 # ---------------- UI ----------------
 with st.sidebar:
@@ -130,7 +549,8 @@ st.title("🐸 개구리 학습 피드백 (Public)")
 st.caption("입력하신 내용은 익명으로 수집되어 서비스 개선에 활용될 수 있어요.")
 
 prompt = st.text_area("학생의 상황을 자세히 입력해주세요:", height=180, key="pub_prompt")
-consent = st.checkbox("동의합니다. 입력 내용이 익명으로 저장되어 서비스 개선에 사용될 수 있음", key="pub_consent")
+consent = st.checkbox("동의합니다. 입력 내용이 익명으로 저장되어 서비스 개선에 사용될 수 있음", key="pub_consent",
+                      on_change=_prefetch_draft)
 
 c1, c2 = st.columns([1,1])
 with c1:
@@ -141,20 +561,50 @@ with c2:
 if "draft_text" not in st.session_state:
     st.session_state.draft_text = ""
 
+_sweep_pending_uploads()
+
 if preview:
     if not prompt.strip():
         st.warning("먼저 상황을 입력해주세요.")
     else:
-        with st.spinner("초안 생성 중..."):
-            text, meta = call_model_tuned(prompt)
+        meta: Dict[str, Any] = {"route": []}
+        text = ""
+        # 동의 체크 때 시작한 미리 생성이 있으면 그 결과를 기다려 쓰고, 없으면 캐시 확인
+        if "_prefetch" in st.session_state:
+            with st.spinner("초안 생성 중..."):
+                text = _take_prefetched(prompt) or ""
             if text:
-                st.session_state.draft_text = text
-                st.success("초안이 생성되었습니다.")
-            else:
-                st.session_state.draft_text = ""
-                st.warning("모델이 빈 응답을 반환했습니다.")
-                with st.expander("디버그"):
-                    st.json(meta)
+                meta["route"].append({"name": "prefetch", "ok": True})
+        if not text:
+            text = cached_draft(prompt) or ""
+            if text:
+                meta["route"].append({"name": "cache", "ok": True})
+        if not text:
+            meta["route"].append({"name": "tuned-stream"})
+            live = st.empty()
+            try:
+                with live.container():
+                    text = (st.write_stream(stream_tuned(prompt)) or "").strip()
+                if text:
+                    remember_draft(prompt, text, {"route": [{"name": "tuned-stream", "ok": True}],
+                                                 "answered_by": TUNED_NAME})
+            except Exception as e:
+                meta["route"][-1]["error"] = repr(e)
+                text = ""
+            live.empty()
+        if not text:
+            # 스트리밍 실패/빈 응답이면 동기 경로(캐시 + 베이스 폴백)로 재시도
+            with st.spinner("초안 생성 중..."):
+                text, sync_meta = call_model_tuned(prompt)
+            meta["route"] += sync_meta["route"]
+        if text:
+            st.session_state.draft_text = text
+            st.success("초안이 생성되었습니다.")
+        else:
+            st.session_state.draft_text = ""
+            st.warning("모델이 빈 응답을 반환했습니다.")
+            with st.expander("디버그"):
+                st.json(meta)
 
 if st.session_state.draft_text:
     st.markdown("### 👁️ AI 초안")
@@ -167,19 +617,25 @@ if submit:
         st.warning("상황을 입력해주세요.")
     else:
         if not st.session_state.draft_text:
-            text, _ = call_model_tuned(prompt)
+            text = _take_prefetched(prompt)
+            if text is None:
+                text, _ = call_model_tuned(prompt)
             st.session_state.draft_text = text or ""
         record = {
-            "timestamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",   # YYYY-MM-DDTHH:MM:SSZ
             "prompt": prompt.strip(),
             "ai_response": st.session_state.draft_text,
             "used_model": TUNED_NAME,
             "source_app": "public",
             "version": "v1",
         }
-        key = _raw_key_for_today()
         try:
-            _upload_json(RAW_BUCKET, key, record)
+            if BATCH_SUBMISSIONS:
+                _submission_queue().put(record)
+            else:
+                key = _raw_key_for_day(_record_day(record))
+                fut = _uploader().submit(_upload_json, RAW_BUCKET, key, record)
+                st.session_state.setdefault("_pending", []).append(fut)
             st.success("제출 완료! 감사합니다 🙏")
             st.session_state.draft_text = ""
         except Exception as e: